@@ -1,13 +1,26 @@
+import logging
 import os
-from fastapi import FastAPI, HTTPException
+import time
+from collections import OrderedDict
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from pymongo import ReturnDocument
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
 from typing import Optional
 
 from database import db
-from schemas import Game
+from migrations import ensure_game_index, migrate_games_if_needed
+from rules import FULL_BOARD, board_from_masks, winner_expr
+from schemas import GAME_DEFAULTS, JoinRequest
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,86 +33,153 @@ app.add_middleware(
 COLL = "game"
 
 
-def calculate_winner(board):
-    lines = [
-        (0, 1, 2), (3, 4, 5), (6, 7, 8),
-        (0, 3, 6), (1, 4, 7), (2, 5, 8),
-        (0, 4, 8), (2, 4, 6)
-    ]
-    for a, b, c in lines:
-        if board[a] and board[a] == board[b] == board[c]:
-            return board[a]
-    return None
+# Collection names shown by /test, refreshed at most once per TTL
+COLLECTIONS_TTL = 60
+app.state.collections = []
+app.state.collections_loaded_at = None
+
+
+async def refresh_collections():
+    app.state.collections = (await db.list_collection_names())[:10]
+    app.state.collections_loaded_at = time.monotonic()
+
+
+@app.on_event("startup")
+async def prepare_database():
+    if db is None:
+        return
+    # Boot even when Mongo is unreachable so /test can report the problem;
+    # any other failure (e.g. duplicate game codes blocking the index) stops startup
+    try:
+        await ensure_game_index(db)
+        await migrate_games_if_needed(db)
+        await refresh_collections()
+    except ConnectionFailure:
+        logger.exception("Database unreachable during startup")
+
+
+GAME_PROJECTION = {"_id": 0}
+MOVE_CHECK_PROJECTION = {
+    "_id": 0,
+    "x_player": 1,
+    "o_player": 1,
+    "x_is_next": 1,
+    "winner": 1,
+    "draw": 1,
+    "x_mask": 1,
+    "o_mask": 1,
+}
+
 
+async def get_game_or_none(game_id: str):
+    return await db[COLL].find_one({"game_id": game_id}, GAME_PROJECTION)
 
-def get_game_or_none(game_id: str):
-    return db[COLL].find_one({"game_id": game_id})
+
+# Encoded GET responses keyed by (game_id, version), least recently used first
+RESPONSE_CACHE_SIZE = 1024
+response_cache = OrderedDict()
+
+
+def cached_game_body(game_id: str, version: int):
+    body = response_cache.get((game_id, version))
+    if body is not None:
+        response_cache.move_to_end((game_id, version))
+    return body
+
+
+def cache_game_body(game_id: str, version: int, body: bytes):
+    response_cache[(game_id, version)] = body
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+
+async def get_game_players(game_id: str):
+    """Fetch only the fields needed to explain a rejected move"""
+    return await db[COLL].find_one({"game_id": game_id}, MOVE_CHECK_PROJECTION)
+
+
+# Stored fields returned to clients as-is; the board is expanded from the masks
+SERIALIZED_FIELDS = (
+    "game_id", "x_starts", "x_is_next", "x_player", "o_player",
+    "winner", "draw", "score_x", "score_o",
+)
 
 
 def serialize_game(doc):
     if not doc:
         return None
-    return {
-        "game_id": doc.get("game_id"),
-        "board": doc.get("board", [None] * 9),
-        "x_starts": doc.get("x_starts", True),
-        "x_is_next": doc.get("x_is_next", True),
-        "x_player": doc.get("x_player"),
-        "o_player": doc.get("o_player"),
-        "winner": doc.get("winner"),
-        "draw": doc.get("draw", False),
-        "score_x": doc.get("score_x", 0),
-        "score_o": doc.get("score_o", 0),
-    }
-
-
-class JoinRequest(BaseModel):
-    game_id: str
-    player_id: str
+    data = {k: doc[k] for k in SERIALIZED_FIELDS}
+    data["board"] = board_from_masks(doc["x_mask"], doc["o_mask"])
+    return data
 
 
-@app.post("/api/game/join")
-def join_game(payload: JoinRequest):
+@app.post("/api/game/join", response_model=None)
+async def join_game(payload: JoinRequest):
     gid = payload.game_id
     pid = payload.player_id
-    if not (gid and len(gid) == 4 and gid.isdigit()):
-        raise HTTPException(status_code=400, detail="game_id must be a 4-digit code")
-
-    game = get_game_or_none(gid)
 
-    # Create new game if it doesn't exist
-    if not game:
-        new_game = Game(game_id=gid).model_dump()
-        new_game["x_player"] = pid
-        db[COLL].insert_one(new_game)
-        game = new_game
+    # Create new game if it doesn't exist; either way get the stored game back
+    new_game = {**GAME_DEFAULTS, "game_id": gid, "x_player": pid}
+    try:
+        game = await db[COLL].find_one_and_update(
+            {"game_id": gid},
+            {"$setOnInsert": new_game},
+            upsert=True,
+            projection=GAME_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Lost a concurrent creation race; join the game that won it
+        game = await get_game_or_none(gid)
+
+    # Determine role (the creator is already stored as x_player)
+    if game["x_player"] == pid:
         role = "X"
+    elif game["o_player"] == pid:
+        role = "O"
     else:
-        # Determine role
-        if game.get("x_player") == pid:
-            role = "X"
-        elif game.get("o_player") == pid:
-            role = "O"
-        elif not game.get("x_player"):
-            db[COLL].update_one({"game_id": gid}, {"$set": {"x_player": pid}})
-            role = "X"
-            game["x_player"] = pid
-        elif not game.get("o_player"):
-            db[COLL].update_one({"game_id": gid}, {"$set": {"o_player": pid}})
-            role = "O"
-            game["o_player"] = pid
+        if not game["x_player"]:
+            role, slot = "X", "x_player"
+        elif not game["o_player"]:
+            role, slot = "O", "o_player"
         else:
             raise HTTPException(status_code=409, detail="Game already has two players")
+        # Claim the free slot only if nobody took it in the meantime
+        game = await db[COLL].find_one_and_update(
+            {"game_id": gid, slot: None},
+            {"$set": {slot: pid}, "$inc": {"version": 1}},
+            projection=GAME_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        if not game:
+            raise HTTPException(status_code=409, detail="Game already has two players")
 
-    return {"role": role, "game": serialize_game(game)}
+    return ORJSONResponse({"role": role, "game": serialize_game(game)})
 
 
-@app.get("/api/game/{game_id}")
-def get_game(game_id: str):
-    game = get_game_or_none(game_id)
-    if not game:
+@app.get("/api/game/{game_id}", response_model=None)
+async def get_game(game_id: str, request: Request):
+    # Read just the version first; unchanged games are served without a full fetch
+    head = await db[COLL].find_one({"game_id": game_id}, {"_id": 0, "version": 1})
+    if not head:
         raise HTTPException(status_code=404, detail="Game not found")
-    return serialize_game(game)
+
+    version = head["version"]
+    etag = f'"{version}"'
+    # Pollers that already hold the current version get an empty 304
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    body = cached_game_body(game_id, version)
+    if body is None:
+        game = await get_game_or_none(game_id)
+        if not game:
+            raise HTTPException(status_code=404, detail="Game not found")
+        version = game["version"]
+        etag = f'"{version}"'
+        body = orjson.dumps(serialize_game(game))
+        cache_game_body(game_id, version, body)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 
 class MoveRequest(BaseModel):
@@ -108,121 +188,153 @@ class MoveRequest(BaseModel):
     player_id: str
 
 
-@app.post("/api/game/{game_id}/move")
-def make_move(game_id: str, payload: MoveRequest):
-    game = get_game_or_none(game_id)
-    if not game:
-        raise HTTPException(status_code=404, detail="Game not found")
-
+@app.post("/api/game/{game_id}/move", response_model=None)
+async def make_move(game_id: str, payload: MoveRequest):
     if payload.role not in ("X", "O"):
         raise HTTPException(status_code=400, detail="Invalid role")
 
+    idx = payload.index
+    if idx < 0 or idx > 8:
+        raise HTTPException(status_code=400, detail="Invalid index")
+
+    # Apply the move only if it is legal against the current stored state
+    is_x = payload.role == "X"
+    bit = 1 << idx
+    filter_doc = {
+        "game_id": game_id,
+        "winner": None,
+        "draw": False,
+        "x_is_next": is_x,
+        "x_mask": {"$bitsAllClear": bit},
+        "o_mask": {"$bitsAllClear": bit},
+        ("x_player" if is_x else "o_player"): payload.player_id,
+    }
+    # Place the piece, flip the turn and settle winner, draw and score in one
+    # server-side pipeline so the whole move is a single atomic write
+    mask = "x_mask" if is_x else "o_mask"
+    score = "score_x" if is_x else "score_o"
+    update_doc = [
+        {
+            "$set": {
+                mask: {"$add": [f"${mask}", bit]},
+                "x_is_next": not is_x,
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            }
+        },
+        {"$set": {"winner": winner_expr(mask, idx, payload.role)}},
+        {
+            "$set": {
+                "draw": {
+                    "$and": [
+                        {"$eq": ["$winner", None]},
+                        {"$eq": [{"$add": ["$x_mask", "$o_mask"]}, FULL_BOARD]},
+                    ]
+                },
+                score: {"$add": [f"${score}", {"$cond": [{"$eq": ["$winner", None]}, 0, 1]}]},
+            }
+        },
+    ]
+    updated = await db[COLL].find_one_and_update(
+        filter_doc,
+        update_doc,
+        projection=GAME_PROJECTION,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    if updated is None:
+        await raise_move_rejection(game_id, payload)
+
+    return ORJSONResponse(serialize_game(updated))
+
+
+async def raise_move_rejection(game_id: str, payload: MoveRequest):
+    """Work out why an atomic move was rejected and raise the matching error"""
+    game = await get_game_players(game_id)
+    if not game:
+        raise HTTPException(status_code=404, detail="Game not found")
+
     # Validate player identity
-    if payload.role == "X" and game.get("x_player") != payload.player_id:
+    if payload.role == "X" and game["x_player"] != payload.player_id:
         raise HTTPException(status_code=403, detail="Not authorized as X")
-    if payload.role == "O" and game.get("o_player") != payload.player_id:
+    if payload.role == "O" and game["o_player"] != payload.player_id:
         raise HTTPException(status_code=403, detail="Not authorized as O")
 
     # If round over, reject
-    if game.get("winner") or game.get("draw"):
+    if game["winner"] or game["draw"]:
         raise HTTPException(status_code=409, detail="Round already finished")
 
     # Validate turn
-    if (payload.role == "X" and not game.get("x_is_next", True)) or (
-        payload.role == "O" and game.get("x_is_next", True)
+    if (payload.role == "X" and not game["x_is_next"]) or (
+        payload.role == "O" and game["x_is_next"]
     ):
         raise HTTPException(status_code=409, detail="Not your turn")
 
-    idx = payload.index
-    if idx < 0 or idx > 8:
-        raise HTTPException(status_code=400, detail="Invalid index")
-
-    board = game.get("board", [None] * 9)
-    if board[idx] is not None:
+    if (game["x_mask"] | game["o_mask"]) >> payload.index & 1:
         raise HTTPException(status_code=409, detail="Square already filled")
 
-    # Apply move
-    board[idx] = payload.role
-    winner = calculate_winner(board)
-    draw = False
-    score_x = game.get("score_x", 0)
-    score_o = game.get("score_o", 0)
-
-    if winner:
-        if winner == "X":
-            score_x += 1
-        else:
-            score_o += 1
-    elif all(v is not None for v in board):
-        draw = True
+    # State changed between the update and this read
+    raise HTTPException(status_code=409, detail="Game state changed, retry")
 
-    x_is_next = not game.get("x_is_next", True)
 
-    db[COLL].update_one(
+@app.post("/api/game/{game_id}/reset-round", response_model=None)
+async def reset_round(game_id: str):
+    # Alternate starting player each round for fairness, toggled server-side
+    updated = await db[COLL].find_one_and_update(
         {"game_id": game_id},
-        {
-            "$set": {
-                "board": board,
-                "x_is_next": x_is_next,
-                "winner": winner,
-                "draw": draw,
-                "score_x": score_x,
-                "score_o": score_o,
+        [
+            {
+                "$set": {
+                    "x_mask": 0,
+                    "o_mask": 0,
+                    "winner": None,
+                    "draw": False,
+                    "x_starts": {"$not": "$x_starts"},
+                    "x_is_next": {"$not": "$x_starts"},
+                    "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+                }
             }
-        },
+        ],
+        projection=GAME_PROJECTION,
+        return_document=ReturnDocument.AFTER,
     )
-
-    updated = get_game_or_none(game_id)
-    return serialize_game(updated)
-
-
-@app.post("/api/game/{game_id}/reset-round")
-def reset_round(game_id: str):
-    game = get_game_or_none(game_id)
-    if not game:
+    if not updated:
         raise HTTPException(status_code=404, detail="Game not found")
+    return ORJSONResponse(serialize_game(updated))
+
 
-    # Alternate starting player each round for fairness
-    next_starter_is_x = not game.get("x_starts", True)
-    db[COLL].update_one(
+@app.post("/api/game/{game_id}/reset-scores", response_model=None)
+async def reset_scores(game_id: str):
+    updated = await db[COLL].find_one_and_update(
         {"game_id": game_id},
-        {
-            "$set": {
-                "board": [None] * 9,
-                "winner": None,
-                "draw": False,
-                "x_starts": next_starter_is_x,
-                "x_is_next": next_starter_is_x,
+        [
+            {
+                "$set": {
+                    "score_x": 0,
+                    "score_o": 0,
+                    "x_mask": 0,
+                    "o_mask": 0,
+                    "winner": None,
+                    "draw": False,
+                    "x_is_next": "$x_starts",
+                    "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+                }
             }
-        },
+        ],
+        projection=GAME_PROJECTION,
+        return_document=ReturnDocument.AFTER,
     )
-
-    updated = get_game_or_none(game_id)
-    return serialize_game(updated)
-
-
-@app.post("/api/game/{game_id}/reset-scores")
-def reset_scores(game_id: str):
-    game = get_game_or_none(game_id)
-    if not game:
+    if not updated:
         raise HTTPException(status_code=404, detail="Game not found")
+    return ORJSONResponse(serialize_game(updated))
 
-    db[COLL].update_one(
-        {"game_id": game_id},
-        {"$set": {"score_x": 0, "score_o": 0, "board": [None] * 9, "winner": None, "draw": False, "x_is_next": game.get("x_starts", True)}},
-    )
-
-    updated = get_game_or_none(game_id)
-    return serialize_game(updated)
 
+@app.get("/", response_model=None)
+async def read_root():
+    return ORJSONResponse({"message": "Tic Tac Toe API running"})
 
-@app.get("/")
-def read_root():
-    return {"message": "Tic Tac Toe API running"}
 
-
-@app.get("/test")
-def test_database():
+@app.get("/test", response_model=None)
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -239,8 +351,10 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, "name") else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+                loaded_at = app.state.collections_loaded_at
+                if loaded_at is None or time.monotonic() - loaded_at > COLLECTIONS_TTL:
+                    await refresh_collections()
+                response["collections"] = app.state.collections
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
@@ -250,13 +364,18 @@ def test_database():
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
-    import os as _os
-    response["database_url"] = "✅ Set" if _os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if _os.getenv("DATABASE_NAME") else "❌ Not Set"
-    return response
+    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
+    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    return ORJSONResponse(response)
 
 
 if __name__ == "__main__":
-    import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
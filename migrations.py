@@ -0,0 +1,84 @@
+"""
+Database Migrations
+
+Bring stored game documents up to the current schema shape.
+Run `python migrations.py` before deploying code that relies on a new shape,
+and again once every old instance has stopped, since those keep writing the
+old shape. The API also applies it at startup if the recorded schema version
+is older.
+"""
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from database import database_name, database_url
+from rules import legacy_board_mask
+from schemas import GAME_DEFAULTS
+
+GAME_COLLECTION = "game"
+
+# Applied schema versions are recorded here so the API only migrates once
+MIGRATIONS_COLLECTION = "migrations"
+GAME_SCHEMA_VERSION = 1
+
+
+async def ensure_game_index(db):
+    """Build the unique game_id index, failing loudly if duplicate games exist"""
+    indexes = await db[GAME_COLLECTION].index_information()
+    if any(info.get("unique") and info["key"] == [("game_id", 1)] for info in indexes.values()):
+        return
+
+    # The old find-then-insert join could race and store the same code twice
+    duplicates = await db[GAME_COLLECTION].aggregate([
+        {"$group": {"_id": "$game_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": 10},
+    ]).to_list(length=None)
+    if duplicates:
+        codes = ", ".join(str(d["_id"]) for d in duplicates)
+        raise Exception(f"Duplicate game_id documents must be resolved before indexing: {codes}")
+
+    await db[GAME_COLLECTION].create_index("game_id", unique=True)
+
+
+async def migrate_games(db):
+    """Give every stored game the full schema shape that serialize_game and the handlers index into"""
+    missing = [{name: {"$exists": False}} for name in GAME_DEFAULTS]
+    fields = {
+        name: {"$ifNull": [f"${name}", default]}
+        for name, default in GAME_DEFAULTS.items()
+    }
+    # Legacy boards become masks before the list is dropped, so games keep their moves
+    fields["x_mask"] = {"$ifNull": ["$x_mask", legacy_board_mask("X")]}
+    fields["o_mask"] = {"$ifNull": ["$o_mask", legacy_board_mask("O")]}
+    await db[GAME_COLLECTION].update_many(
+        {"$or": missing + [{"board": {"$exists": True}}]},
+        [{"$set": fields}, {"$unset": "board"}],
+    )
+    await db[MIGRATIONS_COLLECTION].update_one(
+        {"_id": GAME_COLLECTION},
+        {"$set": {"version": GAME_SCHEMA_VERSION}},
+        upsert=True,
+    )
+
+
+async def migrate_games_if_needed(db):
+    """Run migrate_games unless the recorded schema version is already current"""
+    marker = await db[MIGRATIONS_COLLECTION].find_one({"_id": GAME_COLLECTION})
+    if marker and marker["version"] >= GAME_SCHEMA_VERSION:
+        return
+    await migrate_games(db)
+
+
+async def main():
+    if not (database_url and database_name):
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    # A one-off run may scan the whole collection, so skip the API's short socket timeout
+    client = AsyncIOMotorClient(database_url)
+    await migrate_games(client[database_name])
+    await ensure_game_index(client[database_name])
+    print("Game documents migrated")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
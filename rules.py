@@ -0,0 +1,80 @@
+"""
+Tic Tac Toe Rules
+
+The board is stored as two 9-bit masks, one per player, with bit i set when
+that player holds board cell i.
+"""
+
+# Winning lines as 9-bit masks, bit i set for board cell i
+WINS = (
+    0b000000111, 0b000111000, 0b111000000,
+    0b001001001, 0b010010010, 0b100100100,
+    0b100010001, 0b001010100,
+)
+FULL_BOARD = 0b111111111
+
+# Per cell, the winning lines passing through it (two to four each)
+WIN_LINES_BY_CELL = tuple(
+    tuple(w for w in WINS if w >> i & 1)
+    for i in range(9)
+)
+
+
+def board_from_masks(x_mask, o_mask):
+    return [
+        "X" if x_mask >> i & 1 else "O" if o_mask >> i & 1 else None
+        for i in range(9)
+    ]
+
+
+def cell_taken_expr(mask_field: str, cell: int):
+    """Pipeline expression testing one bit of a mask with plain arithmetic (MongoDB 4.2+)"""
+    return {"$eq": [{"$mod": [{"$trunc": {"$divide": [f"${mask_field}", 1 << cell]}}, 2]}, 1]}
+
+
+def winner_expr(mask_field: str, idx: int, role: str):
+    """Pipeline expression giving role if taking cell idx completed a line, else null
+
+    Only lines through the played cell can have just been completed, and that
+    cell is already set, so just the other two cells of each line are checked.
+    """
+    return {
+        "$cond": [
+            {
+                "$or": [
+                    {
+                        "$and": [
+                            cell_taken_expr(mask_field, cell)
+                            for cell in range(9)
+                            if w >> cell & 1 and cell != idx
+                        ]
+                    }
+                    for w in WIN_LINES_BY_CELL[idx]
+                ]
+            },
+            role,
+            None,
+        ]
+    }
+
+
+def legacy_board_mask(role: str):
+    """Pipeline expression rebuilding a role's mask from a legacy 9-cell board list"""
+    return {
+        "$reduce": {
+            "input": {"$range": [0, 9]},
+            "initialValue": 0,
+            "in": {
+                "$add": [
+                    "$$value",
+                    {
+                        "$cond": [
+                            {"$eq": [{"$arrayElemAt": ["$board", "$$this"]}, role]},
+                            {"$pow": [2, "$$this"]},
+                            0,
+                        ]
+                    },
+                ]
+            },
+        }
+    }
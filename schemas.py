@@ -5,8 +5,8 @@ Define your MongoDB collection schemas here using Pydantic models.
 Each Pydantic model represents a collection in your database.
 Model name is converted to lowercase for the collection name.
 """
-from typing import List, Literal, Optional
-from pydantic import BaseModel, Field, field_validator
+from typing import Annotated, Literal, Optional
+from pydantic import BaseModel, Field, StringConstraints
 
 
 class Game(BaseModel):
@@ -15,10 +15,8 @@ class Game(BaseModel):
     Collection name: "game"
     """
     game_id: str = Field(..., min_length=4, max_length=4, description="4-digit game code")
-    board: List[Optional[Literal['X', 'O']]] = Field(
-        default_factory=lambda: [None] * 9,
-        description="Board state as 9 positions"
-    )
+    x_mask: int = Field(0, ge=0, le=0b111111111, description="Board cells taken by X, bit i for position i")
+    o_mask: int = Field(0, ge=0, le=0b111111111, description="Board cells taken by O, bit i for position i")
     x_starts: bool = Field(True, description="Who starts the current round")
     x_is_next: bool = Field(True, description="Whose turn it is now")
     x_player: Optional[str] = Field(None, description="Identifier for player X")
@@ -27,10 +25,20 @@ class Game(BaseModel):
     draw: bool = Field(False, description="Whether the current round is a draw")
     score_x: int = Field(0, ge=0)
     score_o: int = Field(0, ge=0)
+    version: int = Field(0, ge=0, description="Bumped on every change, used as the ETag")
 
-    @field_validator('board')
-    @classmethod
-    def board_length(cls, v: List[Optional[str]]):
-        if len(v) != 9:
-            raise ValueError('Board must have 9 positions')
-        return v
+
+# Field defaults of a fresh game, taken once from the schema so joins skip validation
+GAME_DEFAULTS = {
+    name: field.default
+    for name, field in Game.model_fields.items()
+    if name != "game_id"
+}
+
+
+class JoinRequest(BaseModel):
+    """
+    Body of POST /api/game/join
+    """
+    game_id: Annotated[str, StringConstraints(pattern=r"^\d{4}$")] = Field(..., description="4-digit game code")
+    player_id: str
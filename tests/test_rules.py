@@ -0,0 +1,102 @@
+import math
+import unittest
+
+from rules import FULL_BOARD, WINS, board_from_masks, legacy_board_mask, winner_expr
+
+
+def evaluate(expr, doc, variables=None):
+    """Evaluate the handful of aggregation operators the rules module emits"""
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith("$$"):
+        return variables[expr[2:]]
+    if isinstance(expr, str) and expr.startswith("$"):
+        return doc.get(expr[1:])
+    if not isinstance(expr, dict):
+        return expr
+    (op, args), = expr.items()
+    if op == "$reduce":
+        value = evaluate(args["initialValue"], doc, variables)
+        for item in evaluate(args["input"], doc, variables):
+            value = evaluate(args["in"], doc, {**variables, "value": value, "this": item})
+        return value
+    values = [evaluate(a, doc, variables) for a in args] if isinstance(args, list) else None
+    if op == "$cond":
+        cond, then, otherwise = args
+        branch = then if evaluate(cond, doc, variables) else otherwise
+        return evaluate(branch, doc, variables)
+    if op == "$or":
+        return any(values)
+    if op == "$eq":
+        return values[0] == values[1]
+    if op == "$and":
+        return all(values)
+    if op == "$trunc":
+        return math.trunc(evaluate(args, doc, variables))
+    if op == "$divide":
+        return values[0] / values[1]
+    if op == "$mod":
+        return values[0] % values[1]
+    if op == "$range":
+        return list(range(*values))
+    if op == "$arrayElemAt":
+        array, index = values
+        if array is None or index >= len(array):
+            return None
+        return array[index]
+    if op == "$pow":
+        return values[0] ** values[1]
+    if op == "$add":
+        return sum(values)
+    raise AssertionError(f"unexpected operator {op}")
+
+
+def wins(mask):
+    return any(mask & w == w for w in WINS)
+
+
+class WinnerExprTest(unittest.TestCase):
+    def test_matches_every_line_through_the_played_cell(self):
+        for idx in range(9):
+            expr = winner_expr("x_mask", idx, "X")
+            for mask in range(FULL_BOARD + 1):
+                # Only positions reachable by playing idx into an unfinished round
+                if not mask >> idx & 1 or wins(mask & ~(1 << idx)):
+                    continue
+                expected = "X" if wins(mask) else None
+                self.assertEqual(evaluate(expr, {"x_mask": mask}), expected, (idx, bin(mask)))
+
+    def test_uses_the_given_field_and_role(self):
+        expr = winner_expr("o_mask", 4, "O")
+        self.assertEqual(evaluate(expr, {"o_mask": 0b100010001}), "O")
+        self.assertIsNone(evaluate(expr, {"o_mask": 0b000010001}))
+
+
+def pack(board, role):
+    return sum(1 << i for i, v in enumerate(board) if v == role)
+
+
+class LegacyBoardMaskTest(unittest.TestCase):
+    BOARDS = [
+        [None] * 9,
+        ["X", None, None, None, None, None, None, None, None],
+        ["X", "O", "X", None, "O", None, None, None, "X"],
+        ["O", "X", "O", "X", "X", "O", "X", "O", "X"],
+        [None, None, None, None, None, None, None, None, "O"],
+    ]
+
+    def test_packs_legacy_boards_like_python(self):
+        for board in self.BOARDS:
+            for role in ("X", "O"):
+                self.assertEqual(evaluate(legacy_board_mask(role), {"board": board}), pack(board, role), (board, role))
+
+    def test_missing_board_gives_empty_mask(self):
+        self.assertEqual(evaluate(legacy_board_mask("X"), {}), 0)
+        self.assertEqual(evaluate(legacy_board_mask("O"), {}), 0)
+
+
+class BoardFromMasksTest(unittest.TestCase):
+    def test_expands_masks_to_cells(self):
+        self.assertEqual(
+            board_from_masks(0b100000101, 0b000010010),
+            ["X", "O", "X", None, "O", None, None, None, "X"],
+        )